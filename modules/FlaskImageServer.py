@@ -1,13 +1,19 @@
 import asyncio
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, send_file, abort, make_response, Response, stream_with_context
+from werkzeug.security import safe_join
 from PIL import Image
 import os
 import time
 import configparser
 import logging
+import uuid
+import threading
 import websockets
-from typing import List, Tuple, Union
+from typing import Dict, List, Tuple, Union
 import json
+from modules.ParallelPixelDecoder import ParallelPixelDecoder, parse_hex_colors, hex_to_rgb
+from modules.TrafficRecorder import TrafficRecorder
+from modules.StreamingPixelDecoder import StreamingPixelDecoder
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -22,14 +28,30 @@ class FlaskImageServer:
 
         self.load_config()
 
+        self.pixel_decoder = ParallelPixelDecoder(self.parallel_decode_workers, self.parallel_decode_min_pixels)
+        self.traffic_recorder = TrafficRecorder(self.record_trace_directory) if self.record_trace_directory else None
+
         self.app = Flask(__name__)
+        self.app.use_x_sendfile = self.use_x_sendfile
         self.app.add_url_rule('/upload_image', 'upload_image', self.upload_image_endpoint, methods=['POST'])
         self.app.add_url_rule('/images/<path:filename>', 'serve_image', self.serve_image)
         self.app.add_url_rule('/latest_images', 'get_latest_images', self.get_latest_images_endpoint)
+        self.app.add_url_rule('/rooms/<int:room_id>/events', 'room_events', self.room_events_endpoint)
 
         self.websocket_clients = set()
+        self.websocket_session_ids = {}
+        # Uploads started with upload_image_begin, keyed by WebSocket connection, as (decoder, room_id)
+        self.websocket_uploads: Dict[object, Tuple[StreamingPixelDecoder, int]] = {}
         self.websocket_server = None
 
+        # Each room's version is bumped whenever an image is saved to it. Long-poll and event stream
+        # requests wait on the condition instead of re-reading the room folder.
+        self.room_versions: Dict[int, int] = {}
+        self.room_update_condition = threading.Condition()
+        self.latest_images_cache: Dict[int, Dict[int, Tuple[int, str]]] = {}
+        # The Werkzeug server gives every waiting request a thread of its own, so the number of waiting requests is capped
+        self.room_watcher_slots = threading.BoundedSemaphore(self.max_room_watchers)
+
     def get_latest_images(self, room_id: int, num_images: int) -> str:
         room_folder_path = os.path.join(self.image_store_path, f"room_{room_id}")
         if not os.path.exists(room_folder_path):
@@ -48,6 +70,49 @@ class FlaskImageServer:
 
         return '|'.join(latest_images)
 
+    def get_room_version(self, room_id: int) -> int:
+        with self.room_update_condition:
+            return self.room_versions.get(room_id, 0)
+
+    def publish_room_update(self, room_number: int):
+        with self.room_update_condition:
+            self.room_versions[room_number] = self.room_versions.get(room_number, 0) + 1
+            self.latest_images_cache.pop(room_number, None)
+            self.room_update_condition.notify_all()
+
+    def wait_for_room_update(self, room_id: int, since: int, timeout_seconds: float) -> int:
+        """
+        Blocks until the room's version differs from since, or the timeout expires. Returns the current version.
+        """
+        with self.room_update_condition:
+            self.room_update_condition.wait_for(lambda: self.room_versions.get(room_id, 0) != since, timeout_seconds)
+            return self.room_versions.get(room_id, 0)
+
+    def get_room_watchers_full_response(self):
+        logging.warning(f"Rejecting room watcher from {request.remote_addr}, {self.max_room_watchers} are already waiting")
+        response = jsonify({'error': f'Too many clients are waiting for room updates, the limit is {self.max_room_watchers}'})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(self.long_poll_timeout_seconds)
+        return response
+
+    def get_cached_latest_images(self, room_id: int, num_images: int) -> Tuple[int, Union[str, Tuple]]:
+        """
+        Returns the room's version along with get_latest_images() for it, only reading the room folder
+        when the room has changed since the last call.
+        """
+        with self.room_update_condition:
+            version = self.room_versions.get(room_id, 0)
+            cached = self.latest_images_cache.get(room_id, {}).get(num_images)
+        if cached is not None and cached[0] == version:
+            return cached
+
+        latest_images = self.get_latest_images(room_id, num_images)
+        if isinstance(latest_images, str):
+            with self.room_update_condition:
+                if self.room_versions.get(room_id, 0) == version:
+                    self.latest_images_cache.setdefault(room_id, {})[num_images] = (version, latest_images)
+        return version, latest_images
+
     def load_config(self):
         config = configparser.ConfigParser()
         config.read(self.config_file_path)
@@ -58,52 +123,57 @@ class FlaskImageServer:
         self.print_received_messages: bool = config['server'].getboolean('print_received_messages')
         self.pixel_receipt_timeout_seconds: int = int(config['server']['pixel_receipt_timeout_seconds'])
         self.max_images_per_room: int = int(config['server']['max_images_per_room'])
+        self.image_cache_max_age_seconds: int = config['server'].getint('image_cache_max_age_seconds', fallback=31536000)
+        self.use_x_sendfile: bool = config['server'].getboolean('use_x_sendfile', fallback=False)
+        self.parallel_decode_workers: int = config['server'].getint('parallel_decode_workers', fallback=0)
+        self.parallel_decode_min_pixels: int = config['server'].getint('parallel_decode_min_pixels', fallback=262144)
+        self.long_poll_timeout_seconds: int = config['server'].getint('long_poll_timeout_seconds', fallback=30)
+        self.event_stream_keepalive_seconds: int = config['server'].getint('event_stream_keepalive_seconds', fallback=15)
+        self.max_room_watchers: int = config['server'].getint('max_room_watchers', fallback=100)
+        self.record_trace_directory: str = config['server'].get('record_trace_directory', fallback='')
+        self.websocket_compression: bool = config['server'].getboolean('websocket_compression', fallback=True)
+        self.websocket_max_message_bytes: int = config['server'].getint('websocket_max_message_bytes', fallback=1048576 * 4)
+        self.max_image_pixels: int = config['server'].getint('max_image_pixels', fallback=4096 * 4096)
 
         logging.info(f"Config loaded from {self.config_file_path}. REST API Port: {self.rest_api_port}, "
                      f"WebSocket Port: {self.websocket_port}, Host: {self.host}, "
                      f"Domain: {self.domain}, "
                      f"Print received messages: {self.print_received_messages}, "
                      f"Pixel receipt timeout seconds: {self.pixel_receipt_timeout_seconds}, "
-                     f"Max images per room: {self.max_images_per_room}")
+                     f"Max images per room: {self.max_images_per_room}, "
+                     f"Image cache max age seconds: {self.image_cache_max_age_seconds}, "
+                     f"Use X-Sendfile: {self.use_x_sendfile}, "
+                     f"Parallel decode workers: {self.parallel_decode_workers}, "
+                     f"Parallel decode min pixels: {self.parallel_decode_min_pixels}, "
+                     f"Long poll timeout seconds: {self.long_poll_timeout_seconds}, "
+                     f"Event stream keepalive seconds: {self.event_stream_keepalive_seconds}, "
+                     f"Max room watchers: {self.max_room_watchers}, "
+                     f"Record trace directory: {self.record_trace_directory}, "
+                     f"WebSocket compression: {self.websocket_compression}, "
+                     f"WebSocket max message bytes: {self.websocket_max_message_bytes}, "
+                     f"Max image pixels: {self.max_image_pixels}")
 
     def parse_hex_colors(self, input_string: str) -> List[str]:
-        colors = []
-        current_color = ""
-        is_first_char = True
-
-        for char in input_string:
-            if char == '#':
-                if current_color != "":
-                    colors.append(current_color)
-                current_color = "#"
-            elif char == "|":
-                if is_first_char:
-                    current_color = "#000000"
-                colors.append(current_color)
-            else:
-                current_color += char
-
-            if is_first_char:
-                is_first_char = False
-
-        if current_color:
-            colors.append(current_color)
-
-        return colors
+        return parse_hex_colors(input_string)
 
     def save_image(self, pixels: List[str], width: int, height: int, room_number: int, notify_clients: bool) -> str:
         image = Image.new("RGB", (width, height))
         pixel_data = [self.hex_to_rgb(hex_color) for hex_color in pixels]
         image.putdata(pixel_data)
-        filename = f"{int(time.time())}.png"
+        return self.write_image(image, room_number, notify_clients)
+
+    def write_image(self, image: Image.Image, room_number: int, notify_clients: bool) -> str:
+        # Images are served as immutable, so every upload needs a URL of its own, even within the same millisecond
+        filename = f"{int(time.time() * 1000)}_{uuid.uuid4().hex[:8]}.png"
 
         save_image_path = os.path.abspath(os.path.join(self.image_store_path, f"room_{room_number}", filename))
         os.makedirs(os.path.dirname(save_image_path), exist_ok=True)
         logging.info(f"Saving image to {save_image_path}")
         image.save(save_image_path)
-        logging.info(f"{width}x{height} image with {len(pixel_data)} pixels saved to {save_image_path}")
+        logging.info(f"{image.width}x{image.height} image with {image.width * image.height} pixels saved to {save_image_path}")
 
         self.cleanup_old_images(room_number)
+        self.publish_room_update(room_number)
 
         if notify_clients:
             loop = asyncio.get_running_loop()
@@ -126,79 +196,273 @@ class FlaskImageServer:
                 logging.info(f"Deleted old image: {file}")
 
     def hex_to_rgb(self, hex_str: str) -> Tuple[int, int, int]:
-        try:
-            if len(hex_str) == 4:  # #RGB format
-                return tuple(int(hex_str[i] * 2, 16) for i in range(1, 4))
-            elif len(hex_str) == 5:  # #RGBA format, ignore the alpha
-                return tuple(int(hex_str[i] * 2, 16) for i in range(1, 4))
-            else:
-                return tuple(int(hex_str[i:i + 2], 16) for i in range(1, 7, 2))
-        except Exception as e:
-            logging.error(f"Error converting hex string {hex_str} to RGB: {e}")
-            return 0, 0, 0
+        return hex_to_rgb(hex_str)
 
     def upload_image(self, pixel_data: str, width: int, height: int, room_number: int, notify_clients: bool) -> Union[str, Tuple[dict, int]]:
-        pixels = self.parse_hex_colors(pixel_data)
-        if len(pixels) == width * height:
+        image = None
+        if self.pixel_decoder.should_decode_in_parallel(width * height):
+            # Large images are decoded across worker processes; anything the parallel path
+            # can't handle falls back to the single-threaded path below.
+            image = self.pixel_decoder.decode(pixel_data, width, height)
+
+        if image is not None:
+            save_image_path = self.write_image(image, room_number, notify_clients)
+        else:
+            pixels = self.parse_hex_colors(pixel_data)
+            if len(pixels) != width * height:
+                error_str = f'Pixel data does not match the given dimensions of {width}x{height}. Received {len(pixels)} pixels, expected {width * height}'
+                logging.error(error_str)
+                return {'error': error_str}, 400
             save_image_path = self.save_image(pixels, width, height, room_number, notify_clients)
-            filename = os.path.basename(save_image_path)
-            image_url = f"http://{self.domain}:{self.rest_api_port}/images/room_{room_number}/{filename}"
-            logging.info(f"Image uploaded successfully: {image_url}")
-            return image_url
 
-        error_str = f'Pixel data does not match the given dimensions of {width}x{height}. Received {len(pixels)} pixels, expected {width * height}'
-        logging.error(error_str)
-        return {'error': error_str}, 400
+        filename = os.path.basename(save_image_path)
+        image_url = f"http://{self.domain}:{self.rest_api_port}/images/room_{room_number}/{filename}"
+        logging.info(f"Image uploaded successfully: {image_url}")
+        return image_url
 
     def upload_image_endpoint(self):
         pixel_data = request.get_data(as_text=True)
         width = int(request.args.get('width'))
         height = int(request.args.get('height'))
         room_number = int(request.args.get('room', 0))
+        if self.traffic_recorder:
+            session_id = self.traffic_recorder.start_session()
+            self.traffic_recorder.record(session_id, 'rest', 'in', [request.args.to_dict(), pixel_data])
         response = self.upload_image(pixel_data, width, height, room_number, notify_clients=False)
+        if self.traffic_recorder:
+            if isinstance(response, str):
+                self.traffic_recorder.record(session_id, 'rest', 'out', [200, response])
+            else:
+                self.traffic_recorder.record(session_id, 'rest', 'out', [400, json.dumps(response)])
+            self.traffic_recorder.end_session(session_id)
         if isinstance(response, str):
             return response, 200
         else:
             return jsonify(response), 400
 
+    @staticmethod
+    def get_image_etag(image_path: str) -> str:
+        # Every upload gets a unique filename and files are never rewritten, so mtime and size identify its contents.
+        stat = os.stat(image_path)
+        return f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
     def serve_image(self, filename):
-        return send_from_directory(self.image_store_path, filename)
+        image_path = safe_join(self.image_store_path, filename)
+        if image_path is None or not os.path.isfile(image_path):
+            abort(404)
+
+        # send_file answers If-None-Match/If-Modified-Since with a 304 and handles Range requests.
+        response = send_file(image_path,
+                             etag=self.get_image_etag(image_path),
+                             max_age=self.image_cache_max_age_seconds,
+                             conditional=True)
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
 
     def get_latest_images_endpoint(self):
         try:
             num_images = int(request.args.get('num_images', 10))
             room_id = int(request.args.get('room_id', 0))
-            response = self.get_latest_images(room_id, num_images)
-            return response, 200
+            since = request.args.get('since')
+            if since is not None:
+                # Long-poll: hold the request until the room changes from the client's version
+                since = int(since)
+                if not self.room_watcher_slots.acquire(blocking=False):
+                    return self.get_room_watchers_full_response()
+                try:
+                    self.wait_for_room_update(room_id, since, self.long_poll_timeout_seconds)
+                finally:
+                    self.room_watcher_slots.release()
+
+            version, response = self.get_cached_latest_images(room_id, num_images)
+            if not isinstance(response, str):
+                return response
+
+            # The URL list changes whenever the room does, so pollers can revalidate with If-None-Match.
+            response = make_response(response, 200)
+            response.headers['X-Room-Version'] = str(version)
+            response.add_etag()
+            response.cache_control.no_cache = True
+            return response.make_conditional(request)
         except Exception as e:
             logging.error(f"Error getting latest images: {e}")
             return jsonify({'error': f'Error getting latest images: {e}'}), 400
 
+    def room_events_endpoint(self, room_id: int):
+        try:
+            num_images = int(request.args.get('num_images', 10))
+            # Clients reconnecting after a dropped stream resume from the last version they received
+            last_event_id = request.headers.get('Last-Event-ID', request.args.get('since'))
+            since = int(last_event_id) if last_event_id is not None else None
+        except Exception as e:
+            # Validate before the stream's headers are sent, after which an error can't be reported
+            logging.error(f"Error starting event stream: {e}")
+            return jsonify({'error': f'Error starting event stream: {e}'}), 400
+
+        if not self.room_watcher_slots.acquire(blocking=False):
+            return self.get_room_watchers_full_response()
+
+        def generate_events():
+            version = since
+            while True:
+                if version is None:
+                    new_version = self.get_room_version(room_id)
+                else:
+                    new_version = self.wait_for_room_update(room_id, version, self.event_stream_keepalive_seconds)
+
+                if new_version == version:
+                    # Comment lines keep proxies from closing the idle stream and detect disconnected clients
+                    yield ": keep-alive\n\n"
+                    continue
+
+                version, latest_images = self.get_cached_latest_images(room_id, num_images)
+                if isinstance(latest_images, str):
+                    yield f"id: {version}\ndata: {latest_images}\n\n"
+
+        logging.info(f"New event stream for room {room_id} from {request.remote_addr}")
+        response = Response(stream_with_context(generate_events()), mimetype='text/event-stream')
+        response.cache_control.no_cache = True
+        response.headers['X-Accel-Buffering'] = 'no'
+        # Werkzeug closes the response once the client disconnects, which frees the slot
+        response.call_on_close(self.room_watcher_slots.release)
+        return response
+
     async def websocket_handler(self, websocket):
         self.websocket_clients.add(websocket)
+        if self.traffic_recorder:
+            self.websocket_session_ids[websocket] = self.traffic_recorder.start_session()
         logging.info(f"New WebSocket connection: {websocket.remote_address}")
         try:
-            async for message in websocket:
-                await self.handle_websocket_message(websocket, message)
+            while True:
+                try:
+                    await self.receive_websocket_message(websocket)
+                except websockets.ConnectionClosedOK:
+                    break
         finally:
             self.websocket_clients.remove(websocket)
+            self.websocket_uploads.pop(websocket, None)
+            if self.traffic_recorder:
+                self.traffic_recorder.end_session(self.websocket_session_ids.pop(websocket))
             logging.info(f"WebSocket connection closed: {websocket.remote_address}")
 
+    async def receive_websocket_message(self, websocket):
+        """
+        Reads one message fragment by fragment. Pixel data is fed to a StreamingPixelDecoder as it arrives,
+        so the server never holds a whole upload message. Other messages are small and are handled once complete.
+        """
+        message = ""
+        upload = None
+        completes_upload = False
+        recorded_fragments = [] if self.traffic_recorder else None
+        error = None
+
+        async for fragment in websocket.recv_streaming():
+            if recorded_fragments is not None:
+                recorded_fragments.append(fragment)
+            if error is not None:
+                # The rest of the message still has to be read before the next one
+                continue
+            try:
+                if upload is not None:
+                    upload[0].feed(fragment)
+                    continue
+                message += fragment
+                streamed_upload = self.get_streamed_upload(websocket, message)
+                if streamed_upload is not None:
+                    upload, body, completes_upload = streamed_upload
+                    upload[0].feed(body)
+                    message = ""
+            except Exception as e:
+                error = e
+
+        if recorded_fragments is not None:
+            # A fragmented message is recorded as its list of fragments, so a replay sends it in the same pieces
+            recorded_message = recorded_fragments[0] if len(recorded_fragments) == 1 else recorded_fragments
+            self.traffic_recorder.record(self.websocket_session_ids[websocket], 'ws', 'in', recorded_message)
+
+        if error is None and upload is not None and completes_upload:
+            try:
+                await self.complete_streamed_upload(websocket, upload)
+            except Exception as e:
+                error = e
+
+        if error is not None:
+            logging.error(f"Error handling WebSocket message: {error}")
+            try:
+                await self.send_websocket_message(websocket, f"Error handling WebSocket message: {error}")
+            except Exception as e:
+                logging.error(f"Error sending error message to WebSocket client: {e}")
+        elif upload is None:
+            await self.handle_websocket_message(websocket, message)
+
+    def get_streamed_upload(self, websocket, message: str) -> Union[Tuple[Tuple[StreamingPixelDecoder, int], str, bool], None]:
+        """
+        Called with the start of a message. Once it is known to carry pixel data, returns the upload it belongs to,
+        the pixel text received so far, and whether the upload is complete at the end of this message.
+        Returns None while more of the message is needed, or if the message isn't pixel data.
+
+        WebSocket uploads are decoded as they are received rather than with the ParallelPixelDecoder, which would
+        need the whole text at once. Decoding overlaps the transfer instead of running on several cores.
+        """
+        upload = self.websocket_uploads.get(websocket)
+        if upload is not None:
+            # While an upload is in progress, every message other than its control messages is pixel data
+            if any(marker.startswith(message) or message.startswith(marker)
+                   for marker in ("upload_image_begin", "upload_image_end")):
+                return None
+            return upload, message, False
+
+        if message.startswith("upload_image?") and ", body=" in message:
+            # Example message: "upload_image?width=100&height=100&room_id=1, body=#FF0000#00FF00#0000FF"
+            params, body = message.split(", body=", 1)
+            logging.info(f"Received upload_image websocket message from client {websocket.remote_address} with params: {params}")
+            return self.create_streamed_upload(params), body, True
+
+        return None
+
+    def create_streamed_upload(self, params: str) -> Tuple[StreamingPixelDecoder, int]:
+        query_params = dict(param.split('=') for param in params.split('?')[1].split('&'))
+        width = int(query_params.get('width'))
+        height = int(query_params.get('height'))
+        room_id = int(query_params.get('room_id', 0))
+        if width <= 0 or height <= 0:
+            raise ValueError(f"Invalid image dimensions {width}x{height}")
+        if width * height > self.max_image_pixels:
+            raise ValueError(f"{width}x{height} image exceeds the maximum of {self.max_image_pixels} pixels")
+        return StreamingPixelDecoder(width, height), room_id
+
+    async def complete_streamed_upload(self, websocket, upload: Tuple[StreamingPixelDecoder, int]):
+        decoder, room_id = upload
+        if not decoder.finish():
+            error_str = (f'Pixel data does not match the given dimensions of {decoder.width}x{decoder.height}. '
+                         f'Received {decoder.pixel_count} pixels, expected {decoder.width * decoder.height}')
+            logging.error(error_str)
+            await self.send_websocket_message(websocket, json.dumps(({'error': error_str}, 400)))
+            return
+
+        save_image_path = self.write_image(decoder.to_image(), room_id, notify_clients=True)
+        filename = os.path.basename(save_image_path)
+        image_url = f"http://{self.domain}:{self.rest_api_port}/images/room_{room_id}/{filename}"
+        logging.info(f"Image uploaded successfully: {image_url}")
+        await self.send_websocket_message(websocket, "upload_image_response=" + image_url)
+
     async def handle_websocket_message(self, websocket, message):
         try:
-            if message.startswith("upload_image"):
-                # Example message: "upload_image?width=100&height=100&room=1, body=#FF0000#00FF00#0000FF"
-                params, body = message.split(", body=", 1)
-                logging.info(f"Received upload_image websocket message from client {websocket.remote_address} with params: {params}")
-                query_params = dict(param.split('=') for param in params.split('?')[1].split('&'))
-                width = int(query_params.get('width'))
-                height = int(query_params.get('height'))
-                room_id = int(query_params.get('room_id', 0))
-                response = self.upload_image(body, width, height, room_id, notify_clients=True)
-                if isinstance(response, str):
-                    await websocket.send("upload_image_response=" + response)
-                else:
-                    await websocket.send(json.dumps(response))
+            if message.startswith("upload_image_begin"):
+                # Example message: "upload_image_begin?width=2048&height=2048&room_id=1"
+                # followed by any number of messages with pixel data, and then "upload_image_end"
+                logging.info(f"Received upload_image_begin websocket message from client {websocket.remote_address} with params: {message}")
+                if websocket in self.websocket_uploads:
+                    logging.warning(f"Discarding unfinished upload from client {websocket.remote_address}")
+                self.websocket_uploads[websocket] = self.create_streamed_upload(message)
+            elif message.startswith("upload_image_end"):
+                upload = self.websocket_uploads.pop(websocket, None)
+                if upload is None:
+                    raise ValueError("upload_image_end received without upload_image_begin")
+                await self.complete_streamed_upload(websocket, upload)
+            elif message.startswith("upload_image"):
+                raise ValueError("upload_image message has no body")
             elif message.startswith("latest_images"):
                 # Example message: "latest_images?room_id=1&num_images=10"
                 params = message.split('?')[1]
@@ -206,38 +470,74 @@ class FlaskImageServer:
                 room_id = int(params.split('&')[0].split('=')[1])
                 num_images = int(params.split('&')[1].split('=')[1])
                 response = self.get_latest_images(room_id, num_images)
-                await websocket.send("latest_images_response=" + response)
+                await self.send_websocket_message(websocket, "latest_images_response=" + response)
         except Exception as e:
             logging.error(f"Error handling WebSocket message: {e}")
             try:
-                await websocket.send(f"Error handling WebSocket message: {e}")
+                await self.send_websocket_message(websocket, f"Error handling WebSocket message: {e}")
             except Exception as e:
                 logging.error(f"Error sending error message to WebSocket client: {e}")
 
+    async def send_websocket_message(self, websocket, message: str):
+        if self.traffic_recorder:
+            self.traffic_recorder.record(self.websocket_session_ids[websocket], 'ws', 'out', message)
+        await websocket.send(message)
+
     async def notify_clients(self, room_number: int):
         if self.websocket_clients:
             message = str(room_number)
             logging.info(f"Sending WebSocket message: {message}")
+            if self.traffic_recorder:
+                for client in self.websocket_clients:
+                    if client in self.websocket_session_ids:
+                        self.traffic_recorder.record(self.websocket_session_ids[client], 'ws', 'push', message)
             await asyncio.gather(*[client.send(message) for client in self.websocket_clients])
 
     def start_rest_api_server(self):
         self.app.run(host=self.host, port=self.rest_api_port)
 
     async def start_websocket_server(self):
-        # Set max_size and read limit for a message to 1MB
+        # max_size limits each message, not the image: larger images are streamed over several
+        # messages between upload_image_begin and upload_image_end.
         self.websocket_server = await websockets.serve(handler=self.websocket_handler,
                                                        host=self.host,
                                                        port=self.websocket_port,
-                                                       max_size=1048576 * 4,
+                                                       compression="deflate" if self.websocket_compression else None,
+                                                       max_size=self.websocket_max_message_bytes,
                                                        write_limit=1048576 * 4)
         logging.info(f"WebSocket server started at ws://{self.host}:{self.websocket_port}")
-        await self.websocket_server.wait_closed()
+        expire_task = asyncio.create_task(self.expire_websocket_uploads())
+        try:
+            await self.websocket_server.wait_closed()
+        finally:
+            expire_task.cancel()
+
+    async def expire_websocket_uploads(self):
+        # An upload started with upload_image_begin is dropped once no pixel data has arrived for
+        # pixel_receipt_timeout_seconds, so an idle connection can't keep holding its buffer
+        while True:
+            await asyncio.sleep(1)
+            now = time.time()
+            for websocket, (decoder, room_id) in list(self.websocket_uploads.items()):
+                if now - decoder.latest_receipt_epoch <= self.pixel_receipt_timeout_seconds:
+                    continue
+                self.websocket_uploads.pop(websocket, None)
+                error_str = (f"Upload of {decoder.width}x{decoder.height} image to room {room_id} timed out after "
+                             f"{self.pixel_receipt_timeout_seconds} seconds without pixel data")
+                logging.warning(f"{error_str} from client {websocket.remote_address}")
+                try:
+                    await self.send_websocket_message(websocket, f"Error handling WebSocket message: {error_str}")
+                except Exception as e:
+                    logging.error(f"Error sending error message to WebSocket client: {e}")
 
     async def start_servers(self):
-        await asyncio.gather(
-            asyncio.to_thread(self.start_rest_api_server),
-            self.start_websocket_server()
-        )
+        try:
+            await asyncio.gather(
+                asyncio.to_thread(self.start_rest_api_server),
+                self.start_websocket_server()
+            )
+        finally:
+            self.pixel_decoder.shutdown()
 
 
 if __name__ == '__main__':
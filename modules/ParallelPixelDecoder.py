@@ -0,0 +1,182 @@
+import itertools
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing.shared_memory import SharedMemory
+from typing import List, Optional, Tuple
+from PIL import Image
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+# The pixel grammar shared by both servers, StreamingPixelDecoder and the decode worker processes.
+# These are module-level functions so that worker processes can use them.
+
+def parse_hex_colors(input_string: str) -> List[str]:
+    # '#' starts a new color and '|' repeats the current one
+    colors = []
+    current_color = ""
+    is_first_char = True
+
+    for char in input_string:
+        if char == '#':
+            if current_color != "":
+                colors.append(current_color)
+            current_color = "#"
+        elif char == "|":
+            if is_first_char:
+                current_color = "#000000"
+            colors.append(current_color)
+        else:
+            current_color += char
+
+        if is_first_char:
+            is_first_char = False
+
+    if current_color:
+        colors.append(current_color)
+
+    return colors
+
+
+def hex_to_rgb(hex_str: str) -> Tuple[int, int, int]:
+    try:
+        if len(hex_str) == 4:  # #RGB format
+            return tuple(int(hex_str[i] * 2, 16) for i in range(1, 4))
+        elif len(hex_str) == 5:  # #RGBA format, ignore the alpha
+            return tuple(int(hex_str[i] * 2, 16) for i in range(1, 4))
+        else:
+            return tuple(int(hex_str[i:i + 2], 16) for i in range(1, 7, 2))
+    except Exception as e:
+        logging.error(f"Error converting hex string {hex_str} to RGB: {e}")
+        return 0, 0, 0
+
+
+def decode_chunk(input_name: str, output_name: str, start: int, end: int, pixel_offset: int) -> int:
+    """
+    Runs in a worker process. Decodes the pixel text in input_name[start:end] and writes the RGB
+    bytes into output_name starting at pixel_offset. Returns the number of pixels written.
+    """
+    input_memory = SharedMemory(name=input_name)
+    output_memory = SharedMemory(name=output_name)
+    try:
+        text = bytes(input_memory.buf[start:end]).decode('utf-8', errors='replace')
+        rgb_data = bytes(itertools.chain.from_iterable(hex_to_rgb(color) for color in parse_hex_colors(text)))
+        output_memory.buf[pixel_offset * 3:pixel_offset * 3 + len(rgb_data)] = rgb_data
+        return len(rgb_data) // 3
+    finally:
+        input_memory.close()
+        output_memory.close()
+
+
+class ParallelPixelDecoder:
+    """
+    Decodes large hex pixel payloads on several cores. The payload is split on '#' boundaries, and each
+    worker process reads its slice from shared memory and writes RGB bytes straight into a shared output
+    buffer, so no pixel lists are pickled between processes.
+    """
+    def __init__(self, num_workers: int, min_pixels: int):
+        self.num_workers = num_workers if num_workers > 0 else (os.cpu_count() or 1)
+        self.min_pixels = min_pixels
+        self.executor = None
+        # The REST server decodes on several threads at once, and they share one pool
+        self.executor_lock = threading.Lock()
+
+        logging.info(f"Parallel pixel decoder configured with {self.num_workers} workers "
+                     f"for images of at least {self.min_pixels} pixels")
+
+    def should_decode_in_parallel(self, pixel_count: int) -> bool:
+        return self.num_workers > 1 and self.min_pixels > 0 and pixel_count >= self.min_pixels
+
+    def get_executor(self) -> ProcessPoolExecutor:
+        with self.executor_lock:
+            if self.executor is None:
+                # Use spawn so that worker processes are not forked from a server with running threads
+                self.executor = ProcessPoolExecutor(max_workers=self.num_workers,
+                                                    mp_context=multiprocessing.get_context('spawn'))
+            return self.executor
+
+    def discard_executor(self, executor: ProcessPoolExecutor):
+        # Another thread may already have replaced the broken pool, in which case the new one is kept
+        with self.executor_lock:
+            if self.executor is executor:
+                self.executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def split_on_color_boundaries(self, data: bytes) -> List[Tuple[int, int, int]]:
+        """
+        Returns (start, end, pixel_offset) for each chunk. Every chunk starts with '#', and since a '#'
+        or '|' each produce exactly one pixel in such a chunk, pixel offsets can be counted up front.
+        """
+        num_chunks = self.num_workers * 4
+        target_chunk_size = max(1, len(data) // num_chunks)
+        chunks = []
+        start = 0
+        pixel_offset = 0
+        while start < len(data):
+            end = data.find(b'#', start + target_chunk_size)
+            if end == -1:
+                end = len(data)
+            chunks.append((start, end, pixel_offset))
+            pixel_offset += data.count(b'#', start, end) + data.count(b'|', start, end)
+            start = end
+        return chunks
+
+    def decode(self, pixel_data: str, width: int, height: int) -> Optional[Image.Image]:
+        """
+        Returns the decoded image, or None if the payload can't be decoded in parallel or doesn't contain
+        exactly width * height pixels. Callers should fall back to the single-threaded path on None.
+        """
+        data = pixel_data.encode('utf-8')
+        # A payload that doesn't start with '#' has special first-pixel handling, so leave it to the single-threaded path
+        if not data.startswith(b'#'):
+            return None
+
+        pixel_count = width * height
+        if data.count(b'#') + data.count(b'|') != pixel_count:
+            return None
+
+        chunks = self.split_on_color_boundaries(data)
+
+        input_memory = SharedMemory(create=True, size=len(data))
+        output_memory = SharedMemory(create=True, size=pixel_count * 3)
+        try:
+            input_memory.buf[:len(data)] = data
+            del data
+
+            executor = self.get_executor()
+            try:
+                futures = [executor.submit(decode_chunk, input_memory.name, output_memory.name, start, end, pixel_offset)
+                           for start, end, pixel_offset in chunks]
+                decoded_pixels = sum(future.result() for future in futures)
+            except BrokenProcessPool as e:
+                # A broken pool stays broken, so drop it and let the next upload start a new one
+                logging.error(f"Decode worker pool broke, falling back to a single process: {e}")
+                self.discard_executor(executor)
+                return None
+            except Exception as e:
+                # Any other error belongs to this upload alone, so the pool is left running for the others
+                logging.error(f"Error decoding pixels in parallel, falling back to a single process: {e}")
+                return None
+            if decoded_pixels != pixel_count:
+                logging.error(f"Parallel decode produced {decoded_pixels} pixels, expected {pixel_count}")
+                return None
+
+            logging.info(f"Decoded {pixel_count} pixels in {len(chunks)} chunks across {self.num_workers} workers")
+            return Image.frombytes("RGB", (width, height), bytes(output_memory.buf[:pixel_count * 3]))
+        finally:
+            input_memory.close()
+            input_memory.unlink()
+            output_memory.close()
+            output_memory.unlink()
+
+    def shutdown(self):
+        with self.executor_lock:
+            executor = self.executor
+            self.executor = None
+        if executor is not None:
+            executor.shutdown()
+            logging.info("Shut down the parallel pixel decoder")
@@ -74,6 +74,10 @@ class RestImageClient:
         else:
             logging.error(f"Failed to upload image: {response.text}")
 
+    def replay_upload(self, params: dict, pixel_data: str, timeout_seconds: float) -> requests.Response:
+        """Re-sends a recorded upload_image request (see TrafficRecorder) to self.uri"""
+        return requests.post(self.uri, data=pixel_data, params=params, timeout=timeout_seconds)
+
     def generate_random_color(self) -> tuple:
         return (random.randint(0, 255), random.randint(0, 255), random.randint(0, 255))
 
@@ -0,0 +1,80 @@
+import itertools
+import logging
+import time
+from typing import List
+from PIL import Image
+from modules.ParallelPixelDecoder import hex_to_rgb
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+class StreamingPixelDecoder:
+    """
+    Decodes hex pixel text that arrives in pieces, such as WebSocket message fragments, into an RGB buffer
+    that grows as pixels arrive. Neither the whole text nor a list of pixels is ever held. Follows the same
+    rules as parse_hex_colors, with a color that is split between pieces carried over to the next one.
+    """
+    def __init__(self, width: int, height: int):
+        self.width = width
+        self.height = height
+        # Not preallocated, so an upload that declares a large size but sends nothing holds no memory
+        self.rgb_data = bytearray()
+        self.pixel_count = 0
+        self.current_color = ""
+        self.is_first_char = True
+        self.latest_receipt_epoch = time.time()
+
+    def feed(self, text: str):
+        self.latest_receipt_epoch = time.time()
+        if not text:
+            return
+
+        if self.is_first_char:
+            self.is_first_char = False
+            if text[0] == '|':
+                # A leading '|' repeats black, as in parse_hex_colors
+                self.current_color = "#000000"
+
+        colors = []
+        segments = text.split('#')
+        self.append_to_current_color(segments[0], colors)
+        for segment in segments[1:]:
+            if self.current_color != "":
+                colors.append(self.current_color)
+            self.current_color = "#"
+            self.append_to_current_color(segment, colors)
+
+        self.write_colors(colors)
+
+    def append_to_current_color(self, segment: str, colors: List[str]):
+        # Each '|' repeats the color built so far, and any following characters keep extending it
+        parts = segment.split('|')
+        self.current_color += parts[0]
+        for part in parts[1:]:
+            colors.append(self.current_color)
+            self.current_color += part
+
+        # hex_to_rgb only reads the first 7 characters of a color longer than 5, so cap how much is carried over
+        if len(self.current_color) > 8:
+            self.current_color = self.current_color[:8]
+
+    def write_colors(self, colors: List[str]):
+        if not colors:
+            return
+
+        rgb_data = bytes(itertools.chain.from_iterable(hex_to_rgb(color) for color in colors))
+        # Pixels beyond the expected size are only counted, so the caller can report the mismatch
+        self.rgb_data += rgb_data[:self.width * self.height * 3 - len(self.rgb_data)]
+        self.pixel_count += len(colors)
+
+    def finish(self) -> bool:
+        """
+        Flushes the last color. Returns True if exactly width * height pixels were received.
+        """
+        if self.current_color:
+            self.write_colors([self.current_color])
+            self.current_color = ""
+        return self.pixel_count == self.width * self.height
+
+    def to_image(self) -> Image.Image:
+        return Image.frombytes("RGB", (self.width, self.height), self.rgb_data)
@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import math
+import time
+from typing import List, Tuple
+from modules.WebSocketImageClient import WebSocketImageClient
+from modules.RestImageClient import RestImageClient
+from modules.TrafficRecorder import TrafficRecorder
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+class TraceReplayer:
+    """
+    Replays traces recorded by TrafficRecorder against a server, preserving each session's start time
+    (scaled by speed) and running at most concurrency sessions at once.
+    """
+    def __init__(self, config_file_path: str, concurrency: int, speed: float, response_timeout_seconds: float):
+        self.websocket_client = WebSocketImageClient(config_file_path)
+        self.rest_client = RestImageClient(config_file_path)
+        self.concurrency = max(1, concurrency)
+        self.speed = speed
+        self.response_timeout_seconds = response_timeout_seconds
+
+        self.latencies: List[float] = []
+        self.requests_sent = 0
+        self.responses_checked = 0
+        self.errors = 0
+
+    async def replay_session(self, channel: str, records: List[list], semaphore: asyncio.Semaphore):
+        async with semaphore:
+            try:
+                if channel == 'ws':
+                    requests_sent, results = await self.websocket_client.replay_session(records, self.speed,
+                                                                                        self.response_timeout_seconds)
+                else:
+                    requests_sent, results = await self.replay_rest_session(records)
+            except Exception as e:
+                logging.error(f"Error replaying {channel} session: {e}")
+                self.responses_checked += 1
+                self.errors += 1
+                return
+
+            self.requests_sent += requests_sent
+            for latency, succeeded in results:
+                self.responses_checked += 1
+                self.latencies.append(latency)
+                if not succeeded:
+                    self.errors += 1
+
+    async def replay_rest_session(self, records: List[list]) -> Tuple[int, List[Tuple[float, bool]]]:
+        requests_sent = 0
+        results = []
+        response = None
+        latency = 0.0
+        for _, _, _, direction, data in records:
+            if direction == 'in':
+                params, pixel_data = data
+                start_epoch = time.perf_counter()
+                response = await asyncio.to_thread(self.rest_client.replay_upload, params, pixel_data,
+                                                   self.response_timeout_seconds)
+                latency = time.perf_counter() - start_epoch
+                requests_sent += 1
+            elif direction == 'out' and response is not None:
+                # Succeeds if the server answers with the recorded status, so a recorded 400 should replay as a 400
+                recorded_status_code = data[0]
+                results.append((latency, response.status_code == recorded_status_code))
+                response = None
+        return requests_sent, results
+
+    async def replay(self, sessions: List[Tuple[str, List[list]]]) -> dict:
+        semaphore = asyncio.Semaphore(self.concurrency)
+        trace_start = sessions[0][1][0][0] if sessions else 0
+        replay_start = time.perf_counter()
+
+        async def start_session(channel: str, records: List[list]):
+            if self.speed > 0:
+                delay = (records[0][0] - trace_start) / self.speed - (time.perf_counter() - replay_start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await self.replay_session(channel, records, semaphore)
+
+        logging.info(f"Replaying {len(sessions)} sessions with concurrency {self.concurrency} at speed {self.speed}")
+        await asyncio.gather(*[start_session(channel, records) for channel, records in sessions])
+        runtime_seconds = time.perf_counter() - replay_start
+
+        return {
+            'sessions': len(sessions),
+            'requests': self.requests_sent,
+            'responses': self.responses_checked,
+            'runtime_seconds': round(runtime_seconds, 2),
+            'throughput_requests_per_second': round(self.requests_sent / runtime_seconds, 2) if runtime_seconds > 0 else 0,
+            'p50_latency_ms': round(self.get_percentile(self.latencies, 50) * 1000, 2),
+            'p99_latency_ms': round(self.get_percentile(self.latencies, 99) * 1000, 2),
+            'error_rate': round(self.errors / self.responses_checked, 4) if self.responses_checked else 0,
+        }
+
+    async def replay_trace_file(self, trace_path: str) -> dict:
+        return await self.replay(TrafficRecorder.load_sessions(trace_path))
+
+    @staticmethod
+    def get_percentile(values: List[float], percentile: float) -> float:
+        # Nearest-rank percentile
+        if not values:
+            return 0.0
+        ordered = sorted(values)
+        rank = max(1, math.ceil(percentile / 100 * len(ordered)))
+        return ordered[rank - 1]
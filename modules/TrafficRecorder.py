@@ -0,0 +1,89 @@
+import atexit
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Tuple, Union
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+class TrafficRecorder:
+    """
+    Records incoming upload traffic to a gzip-compressed trace file, one JSON array per line:
+    [seconds_since_recording_started, session_id, channel, direction, data]
+
+    channel is "ws" or "rest". direction is "in" for client messages, "out" for responses to them, or "push"
+    for messages the server sent unprompted, such as room notifications. For "ws" the data is the message text,
+    or the list of its fragments if the client sent it fragmented. For "rest" it is [query_params, body] for a
+    request and [status_code, response_text] for its response.
+    """
+    def __init__(self, trace_directory: str):
+        self.trace_directory = os.path.abspath(trace_directory)
+        os.makedirs(self.trace_directory, exist_ok=True)
+        # Each recording gets its own file, so session ids and timestamps never mix between server runs
+        recording_epoch = int(time.time())
+        suffix = 0
+        while True:
+            self.trace_path = os.path.join(self.trace_directory,
+                                           f"trace_{recording_epoch}{f'_{suffix}' if suffix else ''}.jsonl.gz")
+            try:
+                self.trace_file = gzip.open(self.trace_path, 'xt', encoding='utf-8')
+                break
+            except FileExistsError:
+                suffix += 1
+        self.lock = threading.Lock()
+        self.start_time = time.monotonic()
+        self.next_session_id = 0
+        atexit.register(self.close)
+        logging.info(f"Recording upload traffic to {self.trace_path}")
+
+    def start_session(self) -> int:
+        with self.lock:
+            session_id = self.next_session_id
+            self.next_session_id += 1
+            return session_id
+
+    def record(self, session_id: int, channel: str, direction: str, data: Union[str, list]):
+        timestamp = round(time.monotonic() - self.start_time, 4)
+        line = json.dumps([timestamp, session_id, channel, direction, data], separators=(',', ':'))
+        with self.lock:
+            if not self.trace_file.closed:
+                self.trace_file.write(line + '\n')
+
+    def end_session(self, session_id: int):
+        # Flushing a gzip file sync-flushes the compressor, so the trace stays readable
+        # up to this point even if the server is killed
+        with self.lock:
+            if not self.trace_file.closed:
+                self.trace_file.flush()
+
+    def close(self):
+        with self.lock:
+            if not self.trace_file.closed:
+                self.trace_file.close()
+                logging.info(f"Closed traffic recording {self.trace_path}")
+
+    @staticmethod
+    def load_sessions(trace_path: str) -> List[Tuple[str, List[list]]]:
+        """
+        Returns (channel, records) for each recorded session, ordered by when the session started.
+        A trace cut short by the server being killed is read up to its last complete record.
+        """
+        sessions: Dict[int, Tuple[str, List[list]]] = {}
+        with gzip.open(trace_path, 'rt', encoding='utf-8') as trace_file:
+            try:
+                for line in trace_file:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        logging.warning(f"Skipping incomplete record in {trace_path}")
+                        continue
+                    session_id, channel = record[1], record[2]
+                    sessions.setdefault(session_id, (channel, []))[1].append(record)
+            except EOFError:
+                logging.warning(f"Trace file {trace_path} ended unexpectedly, it was probably still being recorded")
+
+        return sorted(sessions.values(), key=lambda session: session[1][0][0])
@@ -4,6 +4,10 @@ from PIL import Image
 import configparser
 import logging
 import os
+import time
+import asyncio
+import re
+from typing import List, Tuple
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -21,14 +25,20 @@ class WebSocketImageClient:
         self.port: int = int(config['client']['port'])
         self.send_short_hex: bool = config['client'].getboolean('send_short_hex')
         self.send_pixels_by_row: bool = config['client'].getboolean('send_pixels_by_row')
+        self.websocket_compression: bool = config['client'].getboolean('websocket_compression', fallback=True)
         logging.info(f"Config loaded from {self.config_file_path}. "
                      f"Host: {self.host},"
                      f"Port: {self.port}, "
                      f"Send short hex: {self.send_short_hex}, "
-                     f"Send pixels by row: {self.send_pixels_by_row}")
+                     f"Send pixels by row: {self.send_pixels_by_row}, "
+                     f"WebSocket compression: {self.websocket_compression}")
+
+    def connect(self):
+        # Offer permessage-deflate; hex pixel text compresses well
+        return websockets.connect(self.uri, compression="deflate" if self.websocket_compression else None)
 
     async def get_latest_images(self, room_id: int) -> str:
-        async with websockets.connect(self.uri) as websocket:
+        async with self.connect() as websocket:
             await websocket.send(f"get_latest_images {room_id}")
             response = await websocket.recv()
             return response
@@ -36,7 +46,7 @@ class WebSocketImageClient:
     async def send_random_image(self):
         websocket_messages_sent = 0
         logging.info(f"Sending random image to {self.uri}")
-        async with websockets.connect(self.uri) as websocket:
+        async with self.connect() as websocket:
             await self.send_image_size(websocket, 100, 100, combine=True)
             if self.send_pixels_by_row:
                 pixels = []
@@ -80,24 +90,14 @@ class WebSocketImageClient:
 
         # Iterate over each row in steps of rows_per_message
         for y in range(0, height, rows_per_message):
-            combined_row_colors = ''
-
             # Process up to rows_per_message rows or whatever remains
-            for delta in range(rows_per_message):
-                current_row = y + delta
-                if current_row >= height:  # Check if we've exceeded the image height
-                    break
-
-                row_start = current_row * width
-                row_end = row_start + width
-                row_colors = ''.join([self.rgb_to_hex(rgb) for rgb in pixels[row_start:row_end]])
-
-                # Combine rows into a single string
-                combined_row_colors += row_colors
+            last_row = min(y + rows_per_message, height)
 
-            # Log and send the combined row colors
-            logging.info(f"Sending combined row colors: {combined_row_colors}")
-            await websocket.send(combined_row_colors)
+            # Send each row as a fragment of one message, so the combined rows are never built as a single string
+            row_fragments = (''.join([self.rgb_to_hex(rgb) for rgb in pixels[row * width:(row + 1) * width]])
+                             for row in range(y, last_row))
+            logging.info(f"Sending rows {y} to {last_row - 1}")
+            await websocket.send(row_fragments)
             websocket_messages_sent += 1
 
         return websocket_messages_sent
@@ -115,7 +115,7 @@ class WebSocketImageClient:
         logging.info(f"Sending image from file {image_path} to {self.uri}")
 
         websocket_messages_sent = 0
-        async with websockets.connect(self.uri) as websocket:
+        async with self.connect() as websocket:
             await self.send_image_size(websocket, width, height, combine=True)
             pixels = list(image.getdata())
 
@@ -132,6 +132,58 @@ class WebSocketImageClient:
         response = await websocket.recv()
         logging.info(f"Received from server: {response}")
 
+    async def replay_session(self, records: List[list], speed: float,
+                             response_timeout_seconds: float) -> Tuple[int, List[Tuple[float, bool]]]:
+        """
+        Replays one recorded WebSocket session (see TrafficRecorder) against self.uri. Messages are sent with
+        the recorded gaps divided by speed, or back to back if speed is 0, and a response is awaited wherever
+        the server responded in the recording. Fragmented messages are sent in their recorded fragments.
+        Messages the server pushes unprompted are skipped.
+        Returns the number of messages sent, and (latency_seconds, succeeded) for each response, where latency is
+        measured from the last sent message. A response that doesn't arrive within response_timeout_seconds fails
+        and ends the session.
+        """
+        messages_sent = 0
+        results = []
+        async with self.connect() as websocket:
+            previous_timestamp = records[0][0]
+            last_sent_epoch = time.perf_counter()
+            for timestamp, _, _, direction, message in records:
+                if direction == 'in':
+                    if speed > 0 and timestamp > previous_timestamp:
+                        await asyncio.sleep((timestamp - previous_timestamp) / speed)
+                    last_sent_epoch = time.perf_counter()
+                    # A list of fragments is sent as one fragmented message
+                    await websocket.send(message)
+                    messages_sent += 1
+                elif direction == 'out':
+                    try:
+                        response = await asyncio.wait_for(self.receive_response(websocket), response_timeout_seconds)
+                    except asyncio.TimeoutError:
+                        logging.error(f"No response within {response_timeout_seconds} seconds, ending replayed session")
+                        results.append((time.perf_counter() - last_sent_epoch, False))
+                        break
+                    # Image URLs differ between runs, so only check that the server responded the same way as before
+                    expected_prefix = self.get_response_prefix(message)
+                    succeeded = (response.startswith(expected_prefix)
+                                 and ('/images/' in response) == ('/images/' in message))
+                    results.append((time.perf_counter() - last_sent_epoch, succeeded))
+                previous_timestamp = timestamp
+        return messages_sent, results
+
+    async def receive_response(self, websocket) -> str:
+        # Room notifications ("<room_number>") and subscriber messages aren't responses to what was sent
+        while True:
+            message = await websocket.recv()
+            if not (message.isdigit() or message.startswith(("preview_image=", "latest_image="))):
+                return message
+
+    @staticmethod
+    def get_response_prefix(message: str) -> str:
+        # Named responses look like "upload_image_response=<url>"; others, such as bare image URLs, have no prefix
+        match = re.match(r'[a-z_]+=', message)
+        return match.group(0) if match else ""
+
     def rgb_to_hex(self, rgb: tuple) -> str:
         if self.send_short_hex:
             return f"#{rgb[0] // 16:X}{rgb[1] // 16:X}{rgb[2] // 16:X}"
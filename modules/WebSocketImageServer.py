@@ -8,8 +8,12 @@ from PIL import Image
 import time
 import configparser
 import logging
+import uuid
 import time
-from typing import List
+import math
+from typing import Dict, List, Set
+from modules.ParallelPixelDecoder import ParallelPixelDecoder, parse_hex_colors, hex_to_rgb
+from modules.TrafficRecorder import TrafficRecorder
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 # Only log warnings and errors from aiohttp
@@ -25,6 +29,9 @@ class WebSocketImageServer:
 
         self.load_config()
 
+        self.pixel_decoder = ParallelPixelDecoder(self.parallel_decode_workers, self.parallel_decode_min_pixels)
+        self.traffic_recorder = TrafficRecorder(self.record_trace_directory) if self.record_trace_directory else None
+
         self.width = 0
         self.height = 0
         self.room_number = 1
@@ -34,6 +41,16 @@ class WebSocketImageServer:
         self.pixels = []
         self.image_ready = False
 
+        # Trace session of each open WebSocket connection, while traffic is being recorded
+        self.websocket_session_ids = {}
+        # Clients that sent "subscribe <room_id>", by room number
+        self.room_subscribers: Dict[int, Set[web.WebSocketResponse]] = {}
+        # Incremented for every new image, so that a preview finishing after its image was completed is discarded
+        self.upload_generation = 0
+        self.next_preview_index = 0
+        self.previews_published = False
+        self.preview_task = None
+
     def load_config(self):
         config = configparser.ConfigParser()
         config.read(self.config_file_path)
@@ -43,40 +60,37 @@ class WebSocketImageServer:
         self.print_received_messages: bool = config['server'].getboolean('print_received_messages')
         self.pixel_receipt_timeout_seconds: int = int(config['server']['pixel_receipt_timeout_seconds'])
         self.max_images_per_room: int = int(config['server']['max_images_per_room'])
+        self.image_cache_max_age_seconds: int = config['server'].getint('image_cache_max_age_seconds', fallback=31536000)
+        self.parallel_decode_workers: int = config['server'].getint('parallel_decode_workers', fallback=0)
+        self.parallel_decode_min_pixels: int = config['server'].getint('parallel_decode_min_pixels', fallback=262144)
+        self.record_trace_directory: str = config['server'].get('record_trace_directory', fallback='')
+        self.websocket_compression: bool = config['server'].getboolean('websocket_compression', fallback=True)
+        self.websocket_max_message_bytes: int = config['server'].getint('websocket_max_message_bytes', fallback=1048576 * 4)
+        # Fractions of rows (e.g. "0.25, 0.5, 0.75") after which a preview is published. Empty disables previews.
+        self.progressive_preview_fractions: List[float] = sorted(
+            float(fraction) for fraction in config['server'].get('progressive_preview_fractions', fallback='').split(',')
+            if fraction.strip())
+        self.progressive_preview_max_size: int = config['server'].getint('progressive_preview_max_size', fallback=128)
 
         logging.info(f"Config loaded from {self.config_file_path}. Port: {self.port}, "
                      f"Host: {self.host}, "
                      f"Domain: {self.domain}, "
                      f"Print received messages: {self.print_received_messages}, "
                      f"Pixel receipt timeout seconds: {self.pixel_receipt_timeout_seconds}, "
-                     f"Max images per room: {self.max_images_per_room}")
+                     f"Max images per room: {self.max_images_per_room}, "
+                     f"Image cache max age seconds: {self.image_cache_max_age_seconds}, "
+                     f"Parallel decode workers: {self.parallel_decode_workers}, "
+                     f"Parallel decode min pixels: {self.parallel_decode_min_pixels}, "
+                     f"Record trace directory: {self.record_trace_directory}, "
+                     f"WebSocket compression: {self.websocket_compression}, "
+                     f"WebSocket max message bytes: {self.websocket_max_message_bytes}, "
+                     f"Progressive preview fractions: {self.progressive_preview_fractions}, "
+                     f"Progressive preview max size: {self.progressive_preview_max_size}")
 
     @staticmethod
     def parse_hex_colors(input_string) -> List[str]:
-        # Initialize an empty list to store color codes
-        colors = []
-
-        # Temporary string to accumulate characters of a color code
-        current_color = ""
-
-        # Iterate over each character in the string
-        for char in input_string:
-            # If the character is '#', it indicates the start of a new color code
-            if char == '#':
-                # If there is already a color code being built, add it to the list
-                if current_color:
-                    colors.append(current_color)
-                # Start a new color code
-                current_color = "#"
-            else:
-                # Continue building the current color code
-                current_color += char
-
-        # Add the last color code to the list, if any
-        if current_color:
-            colors.append(current_color)
-
-        return colors
+        # Uses the same rules as the parallel decoder, so an image decodes the same whatever its size
+        return parse_hex_colors(input_string)
 
     def get_latest_images(self, room_id: int) -> str:
         """
@@ -122,113 +136,268 @@ class WebSocketImageServer:
             return ""
 
     async def websocket_handler(self, request):
-        ws = web.WebSocketResponse()
+        # max_msg_size limits each message; images are already sent over many messages, so it doesn't limit image size
+        ws = web.WebSocketResponse(compress=self.websocket_compression, max_msg_size=self.websocket_max_message_bytes)
         await ws.prepare(request)
+        session_id = self.traffic_recorder.start_session() if self.traffic_recorder else None
+        if self.traffic_recorder:
+            self.websocket_session_ids[ws] = session_id
+
+        try:
+            async for msg in ws:
+                if msg.type == web.WSMsgType.TEXT:
+                    message = msg.data
+
+                    if self.print_received_messages:
+                        logging.info(message)
+
+                    if self.traffic_recorder:
+                        self.traffic_recorder.record(session_id, 'ws', 'in', message)
+
+
+                    if message.startswith("subscribe"):
+                        # Subscribe to a room's images
+                        # Message must be in the format "subscribe <room_id>". Subscribers are sent "preview_image=<url>"
+                        # while an image is being uploaded to the room, and "latest_image=<url>" once it's complete.
+                        room_id = int(message.split()[-1])
+                        self.room_subscribers.setdefault(room_id, set()).add(ws)
+                        logging.info(f"Client subscribed to room {room_id}")
+                        continue
+
+                    if message.startswith("get_latest_images"):
+                        # Get the latest images for a room
+                        # Message must be in the format "get_latest_images <room_id>"
+                        latest_images = self.get_latest_images(int(message.split()[-1]))
+                        await self.send_message(ws, session_id, latest_images)
+                        logging.info(f"Sent latest images to client: {latest_images}")
+                        continue
+
+                    # Reset condition based on time elapsed since the last pixel was received
+                    if len(self.pixels) > 1 and (time.time() - self.latest_pixel_receipt_epoch) > self.pixel_receipt_timeout_seconds:
+                        logging.info("Pixel receipt timeout. Resetting.")
+                        self.reset()
+
+                    if self.image_ready and not self.is_start_of_new_image(message):
+                        continue  # Ignore messages if an image has been formed and it's not a start of a new image
+
+                    if self.is_start_of_new_image(message):
+                        self.reset()  # Reset for new image when a new image is indicated by a start message
+
+                    if self.width == 0 or self.height == 0:
+                        logging.info(f"Received message when width or height is 0: {message}")
+                        if self.is_combined_dimensions(message):
+                            dimensions = self.parse_combined_dimensions(message)
+                            self.width, self.height = dimensions
+                            logging.info(f"Received combined dimensions. Width: {self.width}, Height: {self.height}")
+                            logging.info(f"Now expecting {self.width * self.height} pixels")
+                            self.pixel_receipt_start_epoch = time.time()
+                        elif self.width == 0:
+                            self.width = int(message)
+                        elif self.height == 0:
+                            self.height = int(message)
+                            logging.info(f"Now expecting {self.width * self.height} pixels")
+                            self.pixel_receipt_start_epoch = time.time()
+                    elif message in ['1', '2', '3,', '4']:
+                        self.room_number = int(message)
+                        logging.info(f"This image will be uploaded for room number {self.room_number}")
+                    elif len(message) != 7 and len(message) != 4:
+                        # Client sent a row of pixels
+                        self.latest_pixel_receipt_epoch = time.time()
+                        row_pixels = self.parse_hex_colors(message)
+
+                        self.pixels.extend(row_pixels)
+                        self.chunks_received += 1
+                        logging.info(f"Received chunk of {len(row_pixels)} pixels. "
+                                     f"Total received pixels: {len(self.pixels)} Total chunks received: {self.chunks_received}")
+                        self.schedule_preview()
+                        if len(self.pixels) == self.width * self.height:
+                            # Other connections are served while the image is saved and may reset the shared state
+                            room_number = self.room_number
+                            save_image_path = await self.save_image()
+                            filename = os.path.basename(save_image_path)
+                            message_to_send = f"http://{self.domain}:{self.port}/images/room_{room_number}/{filename}"
+                            await self.send_message(ws, session_id, message_to_send)
+                            logging.info(f"Sent message to client: {message_to_send}")
+                            await self.publish_image(room_number, message_to_send)
+                            runtime_seconds = round(time.time() - self.pixel_receipt_start_epoch, 2)
+                            logging.info(f"Total runtime for image creation: {runtime_seconds} seconds")
+                    else:
+                        # Client sent a single pixel
+                        self.latest_pixel_receipt_epoch = time.time()
+                        self.pixels.append(message)
+                        self.schedule_preview()
+                        if len(self.pixels) == self.width * self.height:
+                            # Other connections are served while the image is saved and may reset the shared state
+                            room_number = self.room_number
+                            save_image_path = await self.save_image()
+                            filename = os.path.basename(save_image_path)
+                            message_to_send = f"http://{self.domain}:{self.port}/images/room_{room_number}/{filename}"
+                            await self.send_message(ws, session_id, message_to_send)
+                            logging.info(f"Sent message to client: {message_to_send}")
+                            await self.publish_image(room_number, message_to_send)
+                            runtime_seconds = round(time.time() - self.pixel_receipt_start_epoch, 2)
+                            logging.info(f"Total runtime for image creation: {runtime_seconds} seconds")
+        finally:
+            # Runs even if handling a message raised, so a dead connection is never left subscribed
+            for subscribers in self.room_subscribers.values():
+                subscribers.discard(ws)
+
+            if self.traffic_recorder:
+                self.websocket_session_ids.pop(ws, None)
+                self.traffic_recorder.end_session(session_id)
+
+        return ws
+
+    async def publish_to_subscribers(self, room_number: int, message: str):
+        subscribers = self.room_subscribers.get(room_number)
+        if subscribers:
+            logging.info(f"Sending message to {len(subscribers)} subscribers of room {room_number}: {message}")
+            if self.traffic_recorder:
+                for subscriber in subscribers:
+                    if subscriber in self.websocket_session_ids:
+                        self.traffic_recorder.record(self.websocket_session_ids[subscriber], 'ws', 'push', message)
+            await asyncio.gather(*[subscriber.send_str(message) for subscriber in list(subscribers)],
+                                 return_exceptions=True)
+
+    async def publish_image(self, room_number: int, image_url: str):
+        # The finished image replaces any previews of it
+        await self.publish_to_subscribers(room_number, f"latest_image={image_url}")
+        if self.progressive_preview_fractions:
+            self.delete_previews(room_number)
+
+    def schedule_preview(self):
+        """
+        Called as pixels arrive. Once the next configured fraction of rows has been received, encodes a preview
+        in a worker thread and publishes it to the room's subscribers. Skipped if the previous preview is still encoding.
+        """
+        if self.next_preview_index >= len(self.progressive_preview_fractions) or self.width == 0 or self.height == 0:
+            return
+
+        received_rows = len(self.pixels) // self.width
+        if received_rows >= self.height or received_rows < self.progressive_preview_fractions[self.next_preview_index] * self.height:
+            return
+
+        # Move past every fraction reached so far, so a large chunk of rows only produces one preview
+        while (self.next_preview_index < len(self.progressive_preview_fractions)
+               and received_rows >= self.progressive_preview_fractions[self.next_preview_index] * self.height):
+            self.next_preview_index += 1
+
+        if not self.room_subscribers.get(self.room_number):
+            return
 
-        async for msg in ws:
-            if msg.type == web.WSMsgType.TEXT:
-                message = msg.data
-
-                if self.print_received_messages:
-                    logging.info(message)
-
-
-                if message.startswith("get_latest_images"):
-                    # Get the latest images for a room
-                    # Message must be in the format "get_latest_images <room_id>"
-                    latest_images = self.get_latest_images(int(message.split()[-1]))
-                    await ws.send_str(latest_images)
-                    logging.info(f"Sent latest images to client: {latest_images}")
-                    continue
-
-                # Reset condition based on time elapsed since the last pixel was received
-                if len(self.pixels) > 1 and (time.time() - self.latest_pixel_receipt_epoch) > self.pixel_receipt_timeout_seconds:
-                    logging.info("Pixel receipt timeout. Resetting.")
-                    self.reset()
-
-                if self.image_ready and not self.is_start_of_new_image(message):
-                    continue  # Ignore messages if an image has been formed and it's not a start of a new image
-
-                if self.is_start_of_new_image(message):
-                    self.reset()  # Reset for new image when a new image is indicated by a start message
-
-                if self.width == 0 or self.height == 0:
-                    logging.info(f"Received message when width or height is 0: {message}")
-                    if self.is_combined_dimensions(message):
-                        dimensions = self.parse_combined_dimensions(message)
-                        self.width, self.height = dimensions
-                        logging.info(f"Received combined dimensions. Width: {self.width}, Height: {self.height}")
-                        logging.info(f"Now expecting {self.width * self.height} pixels")
-                        self.pixel_receipt_start_epoch = time.time()
-                    elif self.width == 0:
-                        self.width = int(message)
-                    elif self.height == 0:
-                        self.height = int(message)
-                        logging.info(f"Now expecting {self.width * self.height} pixels")
-                        self.pixel_receipt_start_epoch = time.time()
-                elif message in ['1', '2', '3,', '4']:
-                    self.room_number = int(message)
-                    logging.info(f"This image will be uploaded for room number {self.room_number}")
-                elif len(message) != 7 and len(message) != 4:
-                    # Client sent a row of pixels
-                    self.latest_pixel_receipt_epoch = time.time()
-                    row_pixels = self.parse_hex_colors(message)
-
-                    self.pixels.extend(row_pixels)
-                    self.chunks_received += 1
-                    logging.info(f"Received chunk of {len(row_pixels)} pixels. "
-                                 f"Total received pixels: {len(self.pixels)} Total chunks received: {self.chunks_received}")
-                    if len(self.pixels) == self.width * self.height:
-                        save_image_path = self.save_image()
-                        filename = os.path.basename(save_image_path)
-                        message_to_send = f"http://{self.domain}:{self.port}/images/room_{self.room_number}/{filename}"
-                        await ws.send_str(message_to_send)
-                        logging.info(f"Sent message to client: {message_to_send}")
-                        runtime_seconds = round(time.time() - self.pixel_receipt_start_epoch, 2)
-                        logging.info(f"Total runtime for image creation: {runtime_seconds} seconds")
-                else:
-                    # Client sent a single pixel
-                    self.latest_pixel_receipt_epoch = time.time()
-                    self.pixels.append(message)
-                    if len(self.pixels) == self.width * self.height:
-                        save_image_path = self.save_image()
-                        filename = os.path.basename(save_image_path)
-                        message_to_send = f"http://{self.domain}:{self.port}/images/room_{self.room_number}/{filename}"
-                        await ws.send_str(message_to_send)
-                        logging.info(f"Sent message to client: {message_to_send}")
-                        runtime_seconds = round(time.time() - self.pixel_receipt_start_epoch, 2)
-                        logging.info(f"Total runtime for image creation: {runtime_seconds} seconds")
-
-    def save_image(self):
-        image = Image.new("RGB", (self.width, self.height))
-        pixel_data = [self.hex_to_rgb(hex_color) for hex_color in self.pixels]
-        image.putdata(pixel_data)
-        filename = f"{int(time.time())}.png"
+        if self.preview_task is not None and not self.preview_task.done():
+            logging.info(f"Skipping preview at {received_rows}/{self.height} rows, the previous preview is still encoding")
+            return
+
+        self.preview_task = asyncio.create_task(self.publish_preview(self.pixels, self.width, self.height, received_rows,
+                                                                     self.room_number, self.upload_generation))
+
+    async def publish_preview(self, pixels: List[str], width: int, height: int, received_rows: int,
+                              room_number: int, upload_generation: int):
+        try:
+            loop = asyncio.get_running_loop()
+            preview_path = await loop.run_in_executor(None, self.save_preview, pixels, width, height,
+                                                      received_rows, room_number)
+        except Exception as e:
+            logging.error(f"Error creating preview for room {room_number}: {e}")
+            return
+
+        if upload_generation != self.upload_generation or self.image_ready:
+            # The image was completed or abandoned while the preview was encoding
+            if os.path.exists(preview_path):
+                os.remove(preview_path)
+            return
+
+        self.previews_published = True
+        preview_url = f"http://{self.domain}:{self.port}/images/previews/room_{room_number}/{os.path.basename(preview_path)}"
+        await self.publish_to_subscribers(room_number, f"preview_image={preview_url}")
+
+    def save_preview(self, pixels: List[str], width: int, height: int, received_rows: int, room_number: int) -> str:
+        # Only decode every scale-th pixel of the received rows; the rows still to come are left black
+        scale = max(1, math.ceil(max(width, height) / self.progressive_preview_max_size))
+        preview = Image.new("RGB", (math.ceil(width / scale), math.ceil(height / scale)))
+        preview.putdata([self.hex_to_rgb(pixels[y * width + x])
+                         for y in range(0, received_rows, scale)
+                         for x in range(0, width, scale)])
+
+        filename = f"{int(time.time() * 1000)}.png"
+        preview_path = os.path.abspath(os.path.join(self.image_store_path, "previews", f"room_{room_number}", filename))
+        os.makedirs(os.path.dirname(preview_path), exist_ok=True)
+        preview.save(preview_path)
+        logging.info(f"Saved {preview.width}x{preview.height} preview of {received_rows}/{height} rows to {preview_path}")
+        return preview_path
+
+    def delete_previews(self, room_number: int):
+        preview_folder_path = os.path.join(self.image_store_path, "previews", f"room_{room_number}")
+        if not os.path.exists(preview_folder_path):
+            return
+
+        for file in os.listdir(preview_folder_path):
+            os.remove(os.path.join(preview_folder_path, file))
+
+    async def send_message(self, ws, session_id, message: str):
+        if self.traffic_recorder:
+            self.traffic_recorder.record(session_id, 'ws', 'out', message)
+        await ws.send_str(message)
+
+    async def serve_image(self, request):
+        image_path = os.path.abspath(os.path.join(self.image_store_path,
+                                                  request.match_info['room'],
+                                                  request.match_info['filename']))
+        # Only serve files that sit directly inside a room folder of the image store
+        if os.path.dirname(os.path.dirname(image_path)) != self.image_store_path or not os.path.isfile(image_path):
+            raise web.HTTPNotFound()
+
+        # FileResponse derives a strong ETag from the file's mtime and size, answers conditional
+        # and Range requests, and uses sendfile for the body.
+        return web.FileResponse(image_path, headers={
+            'Cache-Control': f"public, max-age={self.image_cache_max_age_seconds}, immutable"
+        })
+
+    async def save_image(self) -> str:
+        # Decoding and encoding a large image takes a while, so it runs in a worker thread rather than on the event loop.
+        # The image is marked ready first so that further pixels for it are ignored, as they were once it was saved.
+        self.image_ready = True
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.write_image, self.pixels, self.width, self.height, self.room_number)
+
+    def write_image(self, pixels: List[str], width: int, height: int, room_number: int) -> str:
+        image = None
+        if self.pixel_decoder.should_decode_in_parallel(len(pixels)):
+            # Every received pixel starts with '#', so the joined string splits back into the same pixels
+            image = self.pixel_decoder.decode(''.join(pixels), width, height)
+        if image is None:
+            image = Image.new("RGB", (width, height))
+            image.putdata([self.hex_to_rgb(hex_color) for hex_color in pixels])
+        # Images are served as immutable, so every upload needs a URL of its own, even within the same millisecond
+        filename = f"{int(time.time() * 1000)}_{uuid.uuid4().hex[:8]}.png"
 
         # Save path will be self.image_store_path + filename
-        save_image_path = os.path.abspath(os.path.join(self.image_store_path, f"room_{self.room_number}", filename))
+        save_image_path = os.path.abspath(os.path.join(self.image_store_path, f"room_{room_number}", filename))
         os.makedirs(os.path.dirname(save_image_path), exist_ok=True)
         logging.info(f"Saving image to {save_image_path}")
         image.save(save_image_path)
-        logging.info(f"Image saved to {save_image_path} with {len(pixel_data)} pixels.")
-        self.image_ready = True
+        logging.info(f"Image saved to {save_image_path} with {len(pixels)} pixels.")
         return save_image_path
 
     def reset(self):
         logging.info("Resetting server state for new image.")
+        if self.previews_published and not self.image_ready:
+            # The image was abandoned, so nothing else will replace its previews
+            self.delete_previews(self.room_number)
         self.width = 0
         self.height = 0
         self.chunks_received = 0
         self.room_number = 1
         self.pixels = []
         self.image_ready = False
+        self.upload_generation += 1
+        self.next_preview_index = 0
+        self.previews_published = False
 
     @staticmethod
     def hex_to_rgb(hex_str: str) -> tuple:
-        if len(hex_str) == 4:  # Short-form like #FC0
-            return tuple(int(hex_str[i]*2, 16) for i in range(1, 4))
-        else:  # Regular form like #FFCC00
-            return tuple(int(hex_str[i:i+2], 16) for i in range(1, 7, 2))
+        return hex_to_rgb(hex_str)
 
     @staticmethod
     def is_combined_dimensions(message: str) -> bool:
@@ -251,6 +420,10 @@ class WebSocketImageServer:
         app = web.Application()
         app.router.add_route('GET', '/ws', self.websocket_handler)
 
+        # Individual images are immutable once saved, so serve them with long-lived caching headers.
+        # Registered before the static route so that it takes precedence; add_get also handles HEAD.
+        app.router.add_get('/images/{room}/{filename}', self.serve_image)
+
         # Updated to serve images from a specific path and potentially allow directory listing
         static_route_path = '/images'  # Change the URL path to /images
         app.router.add_static(static_route_path, self.image_store_path,
@@ -264,7 +437,10 @@ class WebSocketImageServer:
         logging.info(f"Server running on host: {self.host}:{self.port}")
         logging.info(f"Websocket server running on ws://{self.domain}:{self.port}/ws")
         logging.info(f"Images served from http://{self.domain}:{self.port}/images/room_<room_number>/")
-        await asyncio.Event().wait()  # This will keep the server running indefinitely
+        try:
+            await asyncio.Event().wait()  # This will keep the server running indefinitely
+        finally:
+            self.pixel_decoder.shutdown()
 
 
     @staticmethod
@@ -0,0 +1,32 @@
+from modules.TraceReplayer import TraceReplayer
+import argparse
+import asyncio
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded upload trace against a server and report load statistics.")
+    parser.add_argument("trace_path", help="Trace file written by the server's record_trace_directory option")
+    parser.add_argument("--config", default="config.ini", help="Config file with the [client] section to connect with")
+    parser.add_argument("--concurrency", type=int, default=10, help="Maximum number of sessions replayed at once")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="Speed multiplier for the recorded timing, e.g. 2 replays twice as fast. 0 sends without delays")
+    parser.add_argument("--timeout", type=float, default=30.0,
+                        help="Seconds to wait for each response before counting it as an error")
+    parser.add_argument("--ws-uri", help="Override the WebSocket URI from the config, e.g. ws://localhost:2082/ws")
+    parser.add_argument("--rest-uri", help="Override the upload URI from the config, e.g. http://localhost:5000/upload_image")
+    args = parser.parse_args()
+
+    replayer = TraceReplayer(config_file_path=args.config, concurrency=args.concurrency, speed=args.speed,
+                             response_timeout_seconds=args.timeout)
+    if args.ws_uri:
+        replayer.websocket_client.uri = args.ws_uri
+    if args.rest_uri:
+        replayer.rest_client.uri = args.rest_uri
+
+    report = await replayer.replay_trace_file(args.trace_path)
+    for key, value in report.items():
+        print(f"{key}: {value}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())